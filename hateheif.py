@@ -1,22 +1,94 @@
 
-from io import BytesIO
-from typing import Tuple
+import asyncio
+import base64
+import binascii
+import hashlib
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Tuple
+import numpy as np
+import pillow_heif
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 from PIL import Image
-from pillow_heif import HeifImagePlugin
+from turbojpeg import TurboJPEG, TJFLAG_FASTDCT, TJPF_RGB, TJPF_RGBA, TJSAMP_420
 from typing import Type
 
 from maubot import Plugin, MessageEvent
 from maubot.handlers import command
 from mautrix.client import Client as MatrixClient
-from mautrix.crypto import attachments
-from mautrix.types import EncryptedFile, ImageInfo, MediaMessageEventContent, MessageType
+from mautrix.errors import DecryptionError
+from mautrix.types import EncryptedFile, ImageInfo, JSONWebKey, MediaMessageEventContent, MessageType
 from mautrix.util.config import BaseProxyConfig, ConfigUpdateHelper
 
+# ISO BMFF brands (bytes 8-12 of the `ftyp` box) of HEVC coded HEIF images
+HEIF_BRANDS = (b"heic", b"heix", b"hevc", b"hevx", b"heim", b"heis", b"mif1")
+
+# Decoded modes TurboJPEG reads directly. The alpha channel of RGBA is
+# skipped by the encoder, so no RGBA to RGB conversion pass is needed.
+PIXEL_FORMATS = {"RGB": TJPF_RGB, "RGBA": TJPF_RGBA}
+
+# 4:2:0 chroma halves the chroma DCT work and fixed quality 85 is visually
+# close to the source. No optimized Huffman tables and no progressive scan,
+# both cost an extra pass over the image. The fast integer forward DCT loses
+# a little precision, which is lost in the quantization at quality 85 anyway.
+JPEG_QUALITY = 85
+JPEG_SUBSAMPLE = TJSAMP_420
+JPEG_FLAGS = TJFLAG_FASTDCT
+# MCU height for 4:2:0, bands must start on an MCU row
+JPEG_MCU_SIZE = 16
+# Images at least this tall are encoded as parallel bands, see encode_jpeg_bands
+JPEG_BAND_MIN_HEIGHT = 1024
+# Number of bands an image is split into, not the number of encoder threads
+JPEG_BANDS = min(os.cpu_count() or 1, 4)
+# Per worker thread JPEG output buffer, see encode_jpeg. Buffers up to the
+# size of a band of a 12 MP photo are kept, larger ones are dropped after use.
+_scratch = threading.local()
+_SCRATCH_MAX = 16 * 1024 * 1024
+# Encrypt and hash in chunks small enough to stay in cache between the two passes
+_CRYPT_CHUNK = 64 * 1024
+
+
 class Config(BaseProxyConfig):
     def do_update(self, helper: ConfigUpdateHelper) -> None:
         helper.copy("rooms")
+        helper.copy("max_dim")
+
 
 
+def _unpadded_b64decode(value: str) -> bytes:
+    # JWK keys are URL-safe base64, everything else is standard base64
+    altchars = b"-_" if "-" in value or "_" in value else None
+    return base64.b64decode(value + "=" * (-len(value) % 4), altchars=altchars)
+
+
+def decrypt_attachment(
+        ciphertext: bytes,
+        key: str,
+        hash: str,
+        iv: str) -> bytes:
+    """
+    Verify and decrypt a media file encrypted with AES-256-CTR.
+    :param ciphertext: The encrypted media file.
+    :param key: The unpadded base64 key, from EncryptedFile.key.key.
+    :param hash: The unpadded base64 SHA-256 of the ciphertext.
+    :param iv: The unpadded base64 initialization vector.
+    :return: The media file as bytes.
+    """
+    try:
+        expected_hash = _unpadded_b64decode(hash)
+    except (binascii.Error, TypeError) as e:
+        raise DecryptionError("Error decoding expected hash.") from e
+    # Hash the whole buffer with one update(), so OpenSSL's SHA-NI loop runs over all of it
+    if hashlib.sha256(ciphertext).digest() != expected_hash:
+        raise DecryptionError("Mismatching SHA-256 digest")
+    try:
+        cipher = Cipher(algorithms.AES(_unpadded_b64decode(key)), modes.CTR(_unpadded_b64decode(iv)))
+    except (binascii.Error, TypeError, ValueError) as e:
+        raise DecryptionError("Error decoding key or initial values.") from e
+    decryptor = cipher.decryptor()
+    return decryptor.update(ciphertext) + decryptor.finalize()
+
 
 async def download_encrypted_media(
         file: EncryptedFile,
@@ -27,7 +99,7 @@ async def download_encrypted_media(
     :param client: The Matrix client. Can be accessed via MessageEvent.client
     :return: The media file as bytes.
     """
-    return attachments.decrypt_attachment(
+    return decrypt_attachment(
         await client.download_media(file.url),
         file.key.key,
         file.hashes['sha256'],
@@ -47,6 +119,39 @@ async def download_unencrypted_media(
     return await client.download_media(url)
 
 
+def encrypt_attachment(data: bytearray) -> EncryptedFile:
+    """
+    Encrypt a media file in place with AES-256-CTR (OpenSSL, AES-NI) and hash
+    the ciphertext with SHA-256, both in one pass over the buffer.
+    :param data: The media file, replaced with its ciphertext.
+    :return: The `EncryptedFile` to send along with the uploaded ciphertext.
+    """
+    key = os.urandom(32)
+    iv = os.urandom(8) + bytes(8)
+    encryptor = Cipher(algorithms.AES(key), modes.CTR(iv)).encryptor()
+    sha256 = hashlib.sha256()
+    view = memoryview(data)
+    out = memoryview(bytearray(_CRYPT_CHUNK + 15))
+    for i in range(0, len(view), _CRYPT_CHUNK):
+        chunk = view[i:i + _CRYPT_CHUNK]
+        n = encryptor.update_into(chunk, out)
+        chunk[:] = out[:n]
+        sha256.update(chunk)
+    encryptor.finalize()
+    return EncryptedFile(
+        key=JSONWebKey(
+            key_type="oct",
+            algorithm="A256CTR",
+            extractable=True,
+            key_ops=["encrypt", "decrypt"],
+            key=base64.urlsafe_b64encode(key).decode("utf-8").rstrip("=")
+        ),
+        iv=base64.b64encode(iv).decode("utf-8").rstrip("="),
+        hashes={"sha256": base64.b64encode(sha256.digest()).decode("utf-8").rstrip("=")},
+        version="v2"
+    )
+
+
 async def send_encrypted_message(
         img_enc,
         room_id,
@@ -113,6 +218,138 @@ async def send_unencrypted_message(
 
 
 
+def encode_jpeg(
+        arr: np.ndarray,
+        pixel_format: int,
+        tj: TurboJPEG) -> bytearray:
+    """
+    Encode an image array to JPEG.
+    :param arr: The image as (height, width, channels) array.
+    :param pixel_format: The TurboJPEG pixel format of `arr`.
+    :param tj: The TurboJPEG instance.
+    :return: The JPEG image as bytearray, owned by the caller.
+    """
+    # TurboJPEG needs room for the worst case, reuse the thread's buffer for that
+    # and copy out only the actual JPEG
+    required = tj.buffer_size(arr, JPEG_SUBSAMPLE)
+    buf = getattr(_scratch, "buf", None)
+    if buf is None or len(buf) < required:
+        buf = bytearray(required)
+        if required <= _SCRATCH_MAX:
+            _scratch.buf = buf
+    _, size = tj.encode(
+        arr,
+        quality=JPEG_QUALITY,
+        pixel_format=pixel_format,
+        jpeg_subsample=JPEG_SUBSAMPLE,
+        flags=JPEG_FLAGS,
+        dst=buf
+    )
+    return bytearray(memoryview(buf)[:size])
+
+
+def _jpeg_segments(img: bytearray) -> Dict[int, int]:
+    """
+    Find the header segments of a JPEG.
+    :param img: The JPEG image.
+    :return: Offsets of the segments up to and including SOS, by marker.
+    """
+    offsets = {}
+    pos = 2  # skip SOI
+    while True:
+        marker = img[pos + 1]
+        offsets[marker] = pos
+        if marker == 0xDA:
+            return offsets
+        pos += 2 + int.from_bytes(img[pos + 2:pos + 4], "big")
+
+
+def encode_jpeg_bands(
+        arr: np.ndarray,
+        pixel_format: int,
+        tj: TurboJPEG,
+        pool: ThreadPoolExecutor) -> bytearray:
+    """
+    Encode horizontal bands of an image in parallel and join them into one
+    JPEG, separated by restart markers. The entropy coded data of a band
+    starts with reset DC predictors, exactly like the data after a restart
+    marker, and all bands share the same quantization and Huffman tables.
+    :param arr: The image as (height, width, channels) array.
+    :param pixel_format: The TurboJPEG pixel format of `arr`.
+    :param tj: The TurboJPEG instance.
+    :param pool: The pool to encode the bands in, libjpeg-turbo releases the GIL.
+    :return: The JPEG image as bytearray.
+    """
+    height, width = arr.shape[:2]
+    mcus_per_row = -(-width // JPEG_MCU_SIZE)
+    band_mcu_rows = -(-height // JPEG_MCU_SIZE // JPEG_BANDS)
+    restart_interval = mcus_per_row * band_mcu_rows
+    if JPEG_BANDS < 2 or height < JPEG_BAND_MIN_HEIGHT or restart_interval > 0xFFFF:
+        return encode_jpeg(arr, pixel_format, tj)
+
+    band_height = band_mcu_rows * JPEG_MCU_SIZE
+    bands = list(pool.map(
+        lambda y: encode_jpeg(arr[y:y + band_height], pixel_format, tj),
+        range(0, height, band_height)
+    ))
+
+    # Headers of the first band, with the full height and a restart interval
+    first = bands[0]
+    segments = _jpeg_segments(first)
+    sof, sos = segments[0xC0], segments[0xDA]
+    header = first[:sos]
+    header[sof + 5:sof + 7] = height.to_bytes(2, "big")
+    header += b"\xff\xdd\x00\x04" + restart_interval.to_bytes(2, "big")
+    parts = [header]
+    for i, band in enumerate(bands):
+        sos = _jpeg_segments(band)[0xDA]
+        scan = sos + 2 + int.from_bytes(band[sos + 2:sos + 4], "big")
+        if i == 0:
+            parts.append(memoryview(band)[sos:scan])
+        else:
+            parts.append(bytes((0xFF, 0xD0 + (i - 1) % 8)))  # RSTn
+        parts.append(memoryview(band)[scan:-2])  # without EOI
+    parts.append(b"\xff\xd9")
+    return bytearray().join(parts)
+
+
+def transcode(
+        data: bytes,
+        tj: TurboJPEG,
+        pool: ThreadPoolExecutor,
+        max_dim: int = 0) -> Tuple[bytearray, Tuple[int, int]]:
+    """
+    Convert a HEIF image to JPEG. Runs in a worker thread.
+    :param data: The HEIF image as bytes.
+    :param tj: The TurboJPEG instance, created once in HateHeifBot.start.
+    :param pool: The pool to encode JPEG bands in, see encode_jpeg_bands.
+    :param max_dim: Shrink the image by an integer factor until its longer side
+        fits, 0 keeps the full resolution.
+    :return: The JPEG image as bytearray and its (width, height).
+    """
+    # pillow_heif has no tile or scanline decode API, so the whole image is
+    # decoded once and that buffer is handed to the encoder. This is copy-free
+    # only when libheif returns unpadded rows, see below.
+    # open_heif takes the downloaded bytes as they are, no file wrapper or copy.
+    heif = pillow_heif.open_heif(data, convert_hdr_to_8bit=True)
+    factor = -(-max(heif.size) // max_dim) if max_dim else 1
+    if heif.mode not in PIXEL_FORMATS:
+        # Monochrome images, rare enough to afford a conversion pass
+        img_in = heif.to_pillow().convert("RGB")
+    elif factor > 1:
+        img_in = Image.frombuffer(heif.mode, heif.size, heif.data, "raw", heif.mode, heif.stride, 1)
+    else:
+        # np.asarray honours the row stride, which may be padded past width * channels.
+        # PyTurboJPEG's buffer_size() and encode() call np.ascontiguousarray, so
+        # a padded buffer is copied there, only a contiguous one passes as is.
+        return encode_jpeg_bands(np.asarray(heif), PIXEL_FORMATS[heif.mode], tj, pool), heif.size
+    if factor > 1:
+        # libheif cannot decode at a reduced size, but a box filter shrink is
+        # cheaper than encoding the full resolution
+        img_in = img_in.reduce(factor)
+    return encode_jpeg_bands(np.asarray(img_in), PIXEL_FORMATS[img_in.mode], tj, pool), img_in.size
+
+
 # BOT
 class HateHeifBot(Plugin):
 
@@ -120,6 +357,22 @@ class HateHeifBot(Plugin):
         await super().start()
         self.config.load_and_update()
         self.rooms = self.config['rooms'] if self.config['rooms'] else None
+        try:
+            self._tj = TurboJPEG()
+        except (OSError, RuntimeError, AttributeError) as e:
+            if isinstance(e, RuntimeError) and "Unable to locate" in str(e):
+                self.log.error("libturbojpeg not found, install libjpeg-turbo 2.0 or later (e.g. libturbojpeg0).")
+            else:
+                self.log.error(f"Cannot use the installed libturbojpeg, libjpeg-turbo 2.0 or later is needed: {e}")
+            raise
+        self._pool = ThreadPoolExecutor(max_workers=os.cpu_count())
+        # As many threads as _pool, so concurrent messages still encode on every core
+        self._band_pool = ThreadPoolExecutor(max_workers=os.cpu_count())
+
+    async def stop(self) -> None:
+        self._pool.shutdown(wait=False)
+        self._band_pool.shutdown(wait=False)
+        await super().stop()
 
 
     @command.passive("", msgtypes=(MessageType.IMAGE,MessageType.FILE))
@@ -157,20 +410,20 @@ class HateHeifBot(Plugin):
             self.log.warning("A message with IMAGE type received, but it does not contain a file.")
             return
 
-        # de-heif via pillow
-        img_in = Image.open(BytesIO(data))
-        self.log.debug(f"Received image parameters: {img_in.format} {img_in.size} {img_in.mode}")
-        with BytesIO() as img_out:
-            img_in.save(img_out, format="JPEG")
-            img = img_out.getvalue()
-        img_tst = Image.open(BytesIO(img))
-        self.log.debug(f"Created image parameters: {img_tst.format} {img_tst.size} {img_tst.mode}")
-        content.info.width=img_tst.size[0]
-        content.info.height=img_tst.size[1]
+        # Skip files that only claim to be HEIF, without waking up the decoder
+        if data[4:8] != b"ftyp" or data[8:12] not in HEIF_BRANDS:
+            self.log.debug(f"Ignoring image/heic file with header {data[4:12]!r}, not a HEIF image.")
+            return
+
+        # de-heif off the event loop
+        img, size = await asyncio.get_running_loop().run_in_executor(
+            self._pool, transcode, data, self._tj, self._band_pool, self.config["max_dim"]
+        )
+        self.log.debug(f"Created image parameters: JPEG {size} RGB, {len(img)} bytes")
+        content.info.width, content.info.height = size
 
         if is_enc:
-            img_enc = attachments.encrypt_attachment(img)
-            #self.log.debug(f"{img_enc}")
+            img_enc = (img, encrypt_attachment(img))
             await send_encrypted_message(
                     img_enc,
                     evt.room_id,
@@ -0,0 +1,42 @@
+import os
+
+import pytest
+from mautrix.crypto import attachments
+from mautrix.errors import DecryptionError
+
+import hateheif
+
+SIZES = [0, 1, 15, 64 * 1024, 64 * 1024 + 1, 300_000]
+
+
+@pytest.mark.parametrize("size", SIZES)
+def test_mautrix_decrypts_encrypt_attachment(size):
+    data = os.urandom(size)
+    ciphertext = bytearray(data)
+    file = hateheif.encrypt_attachment(ciphertext)
+    assert attachments.decrypt_attachment(
+        bytes(ciphertext), file.key.key, file.hashes["sha256"], file.iv
+    ) == data
+
+
+@pytest.mark.parametrize("size", SIZES)
+def test_decrypt_attachment_reads_mautrix_encryption(size):
+    data = os.urandom(size)
+    ciphertext, file = attachments.encrypt_attachment(data)
+    assert hateheif.decrypt_attachment(
+        ciphertext, file.key.key, file.hashes["sha256"], file.iv
+    ) == data
+
+
+@pytest.mark.parametrize("field,value", [
+    ("key", "not base64!"),
+    ("key", "c2hvcnQ"),
+    ("iv", "not base64!"),
+    ("iv", "c2hvcnQ"),
+    ("hash", "not base64!"),
+])
+def test_decrypt_attachment_malformed_file(field, value):
+    ciphertext, file = attachments.encrypt_attachment(b"data")
+    args = {"key": file.key.key, "hash": file.hashes["sha256"], "iv": file.iv, field: value}
+    with pytest.raises(DecryptionError):
+        hateheif.decrypt_attachment(ciphertext, **args)
@@ -0,0 +1,42 @@
+import threading
+
+import numpy as np
+
+import hateheif
+
+
+class FakeTurboJPEG:
+    """Writes a fixed payload into dst, sized like TurboJPEG's worst case."""
+
+    def buffer_size(self, arr, jpeg_subsample):
+        return arr.shape[0] * arr.shape[1] * 3 + 2048
+
+    def encode(self, arr, quality, pixel_format, jpeg_subsample, flags, dst):
+        dst[:4] = b"jpeg"
+        return dst, 4
+
+
+def encode_in_fresh_thread(*shapes):
+    """Encode arrays of the given shapes in one new thread, return the kept buffer."""
+    result = {}
+
+    def run():
+        for shape in shapes:
+            assert hateheif.encode_jpeg(np.zeros(shape, np.uint8), hateheif.TJPF_RGB, FakeTurboJPEG()) == b"jpeg"
+        result["buf"] = getattr(hateheif._scratch, "buf", None)
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    thread.join()
+    return result["buf"]
+
+
+def test_scratch_is_allocated_lazily_and_reused():
+    buf = encode_in_fresh_thread((100, 100, 3), (50, 50, 3))
+    assert len(buf) == 100 * 100 * 3 + 2048
+
+
+def test_scratch_above_limit_is_not_kept():
+    big = (hateheif._SCRATCH_MAX // 3 + 1, 1, 3)
+    assert encode_in_fresh_thread(big) is None
+    assert len(encode_in_fresh_thread((100, 100, 3), big)) == 100 * 100 * 3 + 2048
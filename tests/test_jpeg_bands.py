@@ -0,0 +1,36 @@
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+import numpy as np
+import pytest
+from PIL import Image
+
+import hateheif
+
+
+def pillow_encode(arr, pixel_format, tj):
+    """Stand-in for TurboJPEG with the same tables: quality 85, 4:2:0, no optimize."""
+    out = BytesIO()
+    Image.fromarray(arr).save(out, format="JPEG", quality=85, subsampling=2, optimize=False)
+    return bytearray(out.getvalue())
+
+
+def decode(img):
+    return np.asarray(Image.open(BytesIO(bytes(img))).convert("RGB"))
+
+
+@pytest.mark.parametrize("height,width", [
+    (4032, 3024), (1033, 1030), (2000, 17), (1024, 4000), (1100, 5000), (500, 700),
+])
+def test_bands_decode_like_single_pass(monkeypatch, height, width):
+    monkeypatch.setattr(hateheif, "encode_jpeg", pillow_encode)
+    monkeypatch.setattr(hateheif, "JPEG_BANDS", 4)
+    rng = np.random.default_rng(height * width)
+    gradient = np.linspace(0, 235, height * width * 3).reshape(height, width, 3)
+    arr = (gradient + rng.integers(0, 20, gradient.shape)).astype(np.uint8)
+
+    with ThreadPoolExecutor(4) as pool:
+        img = hateheif.encode_jpeg_bands(arr, hateheif.TJPF_RGB, None, pool)
+
+    assert (b"\xff\xdd" in img) == (height >= hateheif.JPEG_BAND_MIN_HEIGHT)
+    assert np.array_equal(decode(img), decode(pillow_encode(arr, hateheif.TJPF_RGB, None)))